@@ -7,6 +7,7 @@
 Generate a set of experiments with synthetic code on mulit-step retrieval task.
 """
 
+import functools
 import gzip
 import hashlib
 import importlib
@@ -16,7 +17,7 @@ import typing
 from dataclasses import asdict, dataclass
 from io import TextIOBase, TextIOWrapper
 from itertools import combinations, permutations
-from typing import Annotated, Iterable, Optional, Union
+from typing import Annotated, Any, Iterable, Optional, Union
 
 import click
 from datasets import load_dataset
@@ -26,6 +27,10 @@ from transformers import AutoTokenizer, PreTrainedTokenizer, PreTrainedTokenizer
 REGEX_STRING = "^[ \t]*(['\"]|$)"
 REGEX_INTEGER = "^[ \t]*([0-9]|$)"
 
+# The random number generator build_dataset reseeds for each dataset,
+# so long-lived workers don't allocate a new generator per task.
+_rng = random.Random()
+
 
 @dataclass
 class Configuration:
@@ -218,6 +223,28 @@ class Configuration:
                 r = typing.get_args(annotation)[1](r)
         return r
 
+    @classmethod
+    def from_dict(cls, values: dict) -> "Configuration":
+        """
+        Create a configuration from a dict, converting values like the command line does
+        and using the command line defaults for missing fields.
+        """
+        ctx = click.Context(CONFIGURATION_COMMAND)
+        fields: dict[str, Any] = {}
+        for param in CONFIGURATION_COMMAND.params:
+            assert param.name is not None
+            value = values.get(param.name)
+            if value is None:
+                if param.required:
+                    raise ValueError(f"missing required configuration {param.name}")
+                fields[param.name] = param.get_default(ctx)
+            else:
+                fields[param.name] = param.type_cast_value(ctx, value)
+        unknown = values.keys() - fields.keys()
+        if unknown:
+            raise ValueError(f"unknown configuration {', '.join(sorted(unknown))}")
+        return cls(**fields)
+
     def default_file_suffix(self):
         """Default file suffix."""
         return "_".join(
@@ -239,6 +266,10 @@ class Configuration:
         )
 
 
+# A command with the click options of the configuration fields, created once.
+CONFIGURATION_COMMAND = click.command()(Configuration.define_options(lambda **_: None))
+
+
 def encode_without_leading_space(
     text: str, tokenizer: Union[PreTrainedTokenizer, PreTrainedTokenizerFast]
 ) -> list[int]:
@@ -252,8 +283,22 @@ def encode_without_leading_space(
     return text_ids[len(newline_ids) :]
 
 
+@functools.lru_cache(maxsize=None)
+def load_tokenizer(
+    model_name: str,
+) -> Union[PreTrainedTokenizer, PreTrainedTokenizerFast]:
+    """Load the tokenizer of the model, cached so it is only loaded once per process."""
+    return AutoTokenizer.from_pretrained(model_name)
+
+
 def load_humaneval(min_length: int = 0, max_length: int = 1000000):
     """Load top-level functions from the HumanEval dataset, and filter by string length to [min_length, max_length]."""
+    return list(_load_humaneval_cached(min_length, max_length))
+
+
+@functools.lru_cache(maxsize=None)
+def _load_humaneval_cached(min_length: int, max_length: int) -> tuple[str, ...]:
+    """Load and filter HumanEval once per process for each length range."""
     ds = load_dataset("openai_humaneval", split="test")
     functions = [
         x["prompt"] + x["canonical_solution"]  # type: ignore
@@ -268,7 +313,7 @@ def load_humaneval(min_length: int = 0, max_length: int = 1000000):
         # Make sure we have the right format.
         assert f.startswith("\ndef") and f.endswith("\n")
         result.append(f.strip())
-    return result
+    return tuple(result)
 
 
 def find_index_of_subarray(array: list[int], subarray: list[int]) -> int:
@@ -445,9 +490,14 @@ def generate_key_retrieval_multistep(
     task_builder_class,
     tokenizer: Union[PreTrainedTokenizer, PreTrainedTokenizerFast],
     cfg: Configuration,
+    rng: Optional[random.Random] = None,
 ):
-    """Generate multi-step key retrieval experiment dataset."""
-    rng = random.Random(cfg.seed)
+    """
+    Generate multi-step key retrieval experiment dataset.
+    The rng must be seeded with cfg.seed and not shared, defaults to random.Random(cfg.seed).
+    """
+    if rng is None:
+        rng = random.Random(cfg.seed)
     humaneval = load_humaneval(
         min_length=cfg.humaneval_min_length,
         max_length=cfg.humaneval_max_length,
@@ -479,12 +529,16 @@ def stream_into_json(stream: TextIOBase, iterator: Iterable):
     return count
 
 
-@click.command()
-@click.argument("task_builder", type=str, required=True)
-@Configuration.define_options
-@click.option("--output", "-o", help="The output file.", type=str)
-def cli(task_builder, output, **kwargs):
-    """The command line entrypoint."""
+def build_dataset(config: dict):
+    """
+    Build a dataset and write it into the output file.
+    The config holds `task_builder`, an optional `output`, and Configuration fields;
+    missing Configuration fields take their command line defaults.
+    """
+    config = dict(config)
+    task_builder = config.pop("task_builder")
+    output = config.pop("output", None)
+
     click.echo(f"Task builder: {task_builder}")
 
     task_builder_class = getattr(
@@ -494,7 +548,7 @@ def cli(task_builder, output, **kwargs):
 
     click.echo(f"Task builder: {task_builder_class}")
 
-    cfg = Configuration(**kwargs)
+    cfg = Configuration.from_dict(config)
     click.echo(f"Configuration: {json.dumps(asdict(cfg), indent=2)}")
 
     if output is None:
@@ -509,10 +563,13 @@ def cli(task_builder, output, **kwargs):
             + ".json"
         )
 
+    # The dataset is fully written before the next one reseeds the generator.
+    _rng.seed(cfg.seed)
     result = generate_key_retrieval_multistep(
         task_builder_class=task_builder_class,
-        tokenizer=AutoTokenizer.from_pretrained(cfg.model_name),
+        tokenizer=load_tokenizer(cfg.model_name),
         cfg=cfg,
+        rng=_rng,
     )
 
     if output.endswith(".gz"):
@@ -525,5 +582,14 @@ def cli(task_builder, output, **kwargs):
     print(f"{count} prompts written into {output}")
 
 
+@click.command()
+@click.argument("task_builder", type=str, required=True)
+@Configuration.define_options
+@click.option("--output", "-o", help="The output file.", type=str)
+def cli(task_builder, output, **kwargs):
+    """The command line entrypoint."""
+    build_dataset({"task_builder": task_builder, "output": output, **kwargs})
+
+
 if __name__ == "__main__":
     cli()
@@ -5,27 +5,33 @@
 
 """Generate data."""
 
-import hashlib
+import contextlib
 import itertools
 import json
+import multiprocessing
 import os
-import subprocess
+import queue
+import sys
 import traceback
-from multiprocessing import cpu_count
-from multiprocessing.pool import ThreadPool
+import warnings
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
 import click
 
 
-def generate_krc(max_prompt_tokens: int):
-    models = [
-        "mistralai/Mistral-7B-v0.1",
-        "bigcode/starcoderbase",
-        "bigcode/starcoderbase-1b",
-        "bigcode/starcoderbase-7b",
-        "bigcode/starcoder2-7b",
-    ]
+MODELS = [
+    "mistralai/Mistral-7B-v0.1",
+    "bigcode/starcoderbase",
+    "bigcode/starcoderbase-1b",
+    "bigcode/starcoderbase-7b",
+    "bigcode/starcoder2-7b",
+]
+
+MAX_PROMPT_TOKENS = [2000, 4000, 8000]
 
+
+def generate_krc(max_prompt_tokens: int):
     variants = ["one-step", "two-step", "three-step", "concatenation"]
 
     distractors = [0, 1, 5]
@@ -49,7 +55,7 @@ def generate_krc(max_prompt_tokens: int):
         "concatenation": 50,  # max number = 20 * 6 * 50 = 6000
     }
 
-    combinations = itertools.product(models, variants, distractors, seeds)
+    combinations = itertools.product(MODELS, variants, distractors, seeds)
     for model, variant, distractors, seed in combinations:
         mname = model.split("/")[-1]
         yield "krc", {
@@ -70,14 +76,6 @@ def generate_krc(max_prompt_tokens: int):
 
 
 def generate_krfix(max_prompt_tokens: int):
-    models = [
-        "mistralai/Mistral-7B-v0.1",
-        "bigcode/starcoderbase",
-        "bigcode/starcoderbase-1b",
-        "bigcode/starcoderbase-7b",
-        "bigcode/starcoder2-7b",
-    ]
-
     variants = ["three-step", "concatenation"]
 
     distractors = [5]
@@ -98,7 +96,7 @@ def generate_krfix(max_prompt_tokens: int):
     }
 
     combinations = itertools.product(
-        models,
+        MODELS,
         variants,
         distractors,
         call_graph_comment_types,
@@ -134,14 +132,6 @@ def generate_krfix(max_prompt_tokens: int):
 
 
 def generate_krfix_one_hop(max_prompt_tokens: int):
-    models = [
-        "mistralai/Mistral-7B-v0.1",
-        "bigcode/starcoderbase",
-        "bigcode/starcoderbase-1b",
-        "bigcode/starcoderbase-7b",
-        "bigcode/starcoder2-7b",
-    ]
-
     variants = ["three-step"]
 
     distractors = [5]
@@ -164,7 +154,7 @@ def generate_krfix_one_hop(max_prompt_tokens: int):
     }
 
     combinations = itertools.product(
-        models,
+        MODELS,
         variants,
         distractors,
         call_graph_comment_types,
@@ -200,52 +190,142 @@ def generate_krfix_one_hop(max_prompt_tokens: int):
         }
 
 
-def tasks(configs) -> list[list[str]]:
+def tasks(configs) -> list[dict]:
     result = []
+    output_dirs = set()
     for experiment, config in configs:
-        args = [experiment]
-        for key, value in config.items():
-            if value is not None:
-                args += [f"--{key}", str(value)]
-        os.makedirs(os.path.dirname(config["output"]), exist_ok=True)
-        result.append(args)
+        output_dirs.add(os.path.dirname(config["output"]))
+        result.append({"task_builder": experiment, **config})
+    for output_dir in output_dirs:
+        os.makedirs(output_dir, exist_ok=True)
     return result
 
 
-def run_tasks_in_parallel(task_list: list[list[str]]):
-    def work(arguments: list[str]):
-        os.makedirs("./logs", exist_ok=True)
-        key = hashlib.sha1(json.dumps(arguments).encode("utf-8")).hexdigest()
-        f_stdout = f"./logs/{key}.stdout"
-        f_stderr = f"./logs/{key}.stderr"
-        with open(f_stdout, "wb") as out, open(f_stderr, "wb") as err:
-            out.write((json.dumps(arguments) + "\n\n").encode("utf-8"))
-            err.write((json.dumps(arguments) + "\n\n").encode("utf-8"))
-            success = False
+def _init_worker(free_cores):
+    """Initialize a long-lived worker: pin it to a core and preload heavy modules."""
+    if free_cores is not None:
+        # Pin the worker to its own core (Linux only) so the scheduler doesn't
+        # migrate it around and thrash its caches.
+        try:
+            os.sched_setaffinity(0, {free_cores.get_nowait()})
+        except queue.Empty:
+            pass
+
+    # Import transformers / datasets once per worker instead of once per task.
+    import data_generator  # noqa: F401
+
+
+@contextlib.contextmanager
+def _redirect_output(log):
+    """Redirect stdout and stderr of the current process into the log file."""
+    # Redirect the file descriptors rather than sys.stdout / sys.stderr, so
+    # handlers that bound the original streams (e.g. transformers logging)
+    # and native code also write into the log.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    log.flush()
+    saved_fds = [os.dup(1), os.dup(2)]
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    try:
+        # Reset the "once" warning registries, so each task logs its own warnings.
+        with warnings.catch_warnings():
+            yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        for fd in saved_fds:
+            os.close(fd)
+
+
+def _run_task(log_dir: str, task: tuple[int, dict]) -> tuple[dict, bool, str]:
+    """Build a single dataset in the current worker, logging its output into log_dir."""
+    import data_generator
+
+    index, config = task
+    f_log = f"{log_dir}/task_{index:04d}.log"
+    with open(f_log, "w", encoding="utf-8") as log:
+        log.write(json.dumps(config) + "\n\n")
+        # stdout and stderr go into the same log.
+        with _redirect_output(log):
             try:
-                subprocess.check_call(
-                    ["python", "data_generator.py"] + arguments,
-                    stdout=out,
-                    stderr=err,
-                )
-                success = True
-            except:
-                click.echo(
-                    click.style("[Error]", fg="red")
-                    + f" {' '.join(arguments)}, see {f_stderr}"
-                )
+                data_generator.build_dataset(config)
+            except BaseException:
                 traceback.print_exc()
-            if success:
-                click.echo(
-                    click.style("[Success]", fg="green") + f" {' '.join(arguments)}"
-                )
-
-    tp = ThreadPool(min(cpu_count(), 16))
-    for arguments in task_list:
-        tp.apply_async(work, (arguments,))
-
-    tp.close()
-    tp.join()
+                return config, False, f_log
+    return config, True, f_log
+
+
+def run_tasks_in_parallel(task_list: list[dict], log_dir: str):
+    os.makedirs(log_dir, exist_ok=True)
+    ctx = multiprocessing.get_context("forkserver")
+    num_workers = multiprocessing.cpu_count()
+
+    cores = None
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        num_workers = len(cores)
+
+    def new_executor() -> ProcessPoolExecutor:
+        free_cores = None
+        if cores is not None:
+            free_cores = ctx.Queue()
+            for core in cores:
+                free_cores.put(core)
+        return ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(free_cores,),
+        )
+
+    def report(future: Future, task: tuple[int, dict]) -> bool:
+        """Report the result of the task, returns True if the pool broke."""
+        index, config = task
+        broken = False
+        try:
+            _, success, f_log = future.result()
+        except BrokenProcessPool:
+            # A worker process died while running this task.
+            broken = True
+            success, f_log = False, f"{log_dir}/task_{index:04d}.log"
+        if success:
+            click.echo(click.style("[Success]", fg="green") + f" {config['output']}")
+        else:
+            reason = ", worker process died" if broken else ""
+            click.echo(
+                click.style("[Error]", fg="red")
+                + f" {config['output']}{reason}, see {f_log}"
+            )
+        return broken
+
+    # Long-lived workers pick up tasks one by one, so interpreter startup and
+    # the transformers / datasets imports are paid once per worker.
+    # Tokenizers are cached per worker, so keep tasks of the same model together.
+    task_list = sorted(task_list, key=lambda config: config["model_name"])
+    pending = iter(enumerate(task_list))
+    running: dict[Future, tuple[int, dict]] = {}
+    executor = new_executor()
+    try:
+        while True:
+            # Only keep one task per worker in flight, so if a worker dies (e.g.
+            # killed by the OOM killer) only the tasks that were running are lost.
+            for task in itertools.islice(pending, num_workers - len(running)):
+                running[executor.submit(_run_task, log_dir, task)] = task
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            if any([report(future, running.pop(future)) for future in done]):
+                # The pool is broken: the remaining running tasks failed with it.
+                done, _ = wait(running)
+                for future in done:
+                    report(future, running.pop(future))
+                executor.shutdown()
+                executor = new_executor()
+    finally:
+        executor.shutdown()
 
 
 @click.group()
@@ -256,28 +336,25 @@ def cli():
 @cli.command()
 def krc():
     all_tasks = []
-    all_tasks += tasks(generate_krc(2000))
-    all_tasks += tasks(generate_krc(4000))
-    all_tasks += tasks(generate_krc(8000))
-    run_tasks_in_parallel(all_tasks)
+    for max_prompt_tokens in MAX_PROMPT_TOKENS:
+        all_tasks += tasks(generate_krc(max_prompt_tokens))
+    run_tasks_in_parallel(all_tasks, log_dir="./logs/krc")
 
 
 @cli.command()
 def krfix():
     all_tasks = []
-    all_tasks += tasks(generate_krfix(2000))
-    all_tasks += tasks(generate_krfix(4000))
-    all_tasks += tasks(generate_krfix(8000))
-    run_tasks_in_parallel(all_tasks)
+    for max_prompt_tokens in MAX_PROMPT_TOKENS:
+        all_tasks += tasks(generate_krfix(max_prompt_tokens))
+    run_tasks_in_parallel(all_tasks, log_dir="./logs/krfix")
 
 
 @cli.command()
 def krfix_one_hop():
     all_tasks = []
-    all_tasks += tasks(generate_krfix_one_hop(2000))
-    all_tasks += tasks(generate_krfix_one_hop(4000))
-    all_tasks += tasks(generate_krfix_one_hop(8000))
-    run_tasks_in_parallel(all_tasks)
+    for max_prompt_tokens in MAX_PROMPT_TOKENS:
+        all_tasks += tasks(generate_krfix_one_hop(max_prompt_tokens))
+    run_tasks_in_parallel(all_tasks, log_dir="./logs/krfix_one_hop")
 
 
 if __name__ == "__main__":
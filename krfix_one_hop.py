@@ -4,7 +4,10 @@
 #
 
 import random
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Optional
+
+if TYPE_CHECKING:
+    from data_generator import Configuration
 
 
 class TaskBuilder:
@@ -18,11 +21,34 @@ class TaskBuilder:
     and inserting irrelevant segments between them and the generation prompt.
     """
 
-    def __init__(self, configuration, random_number_generator: random.Random):
+    def __init__(
+        self,
+        configuration: "Configuration",
+        random_number_generator: random.Random,
+    ) -> None:
         self.rng = random_number_generator
         self.cfg = configuration
 
         self.used_values: set[str] = set()
+        # The next index to try for each canonical function name.
+        self._name_counter: dict[str, int] = {}
+
+        # Resolve the configured generators once, value() and function_name() are hot.
+        self._value_impl: Callable[[int], str]
+        if configuration.return_type == "string":
+            self._value_impl = self._value_string
+        elif configuration.return_type == "integer":
+            self._value_impl = self._value_integer
+        else:
+            raise ValueError("return_type must be 'string' or 'integer'")
+
+        self._name_impl: Callable[[str], str]
+        if configuration.function_name == "random":
+            self._name_impl = self._name_random
+        elif configuration.function_name == "fixed":
+            self._name_impl = self._name_fixed
+        else:
+            raise ValueError("function_name must be 'fixed' or 'random'")
 
     def random_string(self, length: int) -> str:
         """Generates a random string."""
@@ -38,61 +64,70 @@ class TaskBuilder:
             r += self.rng.choice("0123456789" if r != "" else "123456789")
         return r
 
-    def uniquify(self, generator, **kwargs) -> str:
+    def uniquify(self, generator: Callable[..., str], **kwargs: int) -> str:
         """Run the generator function until it returns a value that hasn't been returned."""
+        used_values = self.used_values
         while True:
             v = generator(**kwargs)
-            if v not in self.used_values:
-                self.used_values.add(v)
+            if v not in used_values:
+                used_values.add(v)
                 return v
 
     def value(self, length: Optional[int] = None) -> str:
         """Generates a new string value."""
         if length is None:
             length = self.cfg.return_length
-        if self.cfg.return_type == "string":
-            s = self.uniquify(self.random_string, length=length)
-            return '"' + s + '"'
-        elif self.cfg.return_type == "integer":
-            return self.uniquify(self.random_integer, length=length)
-        else:
-            raise ValueError("return_type must be 'string' or 'integer'")
+        return self._value_impl(length)
+
+    def _value_string(self, length: int) -> str:
+        """Generates a new quoted string value."""
+        s = self.uniquify(self.random_string, length=length)
+        return '"' + s + '"'
+
+    def _value_integer(self, length: int) -> str:
+        """Generates a new integer value."""
+        return self.uniquify(self.random_integer, length=length)
 
     def function_name(self, canonical: str) -> str:
         """Generates a new function name."""
-        if self.cfg.function_name == "random":
-            n_parts = self.rng.randint(
-                self.cfg.function_name_min_parts,
-                self.cfg.function_name_max_parts,
-            )
-            parts = []
-            length = self.cfg.function_name_part_length
-            for i in range(n_parts):
-                if i == 0:
-                    fn = self.random_string
-                elif i == 1:
-                    fn = self.random_integer
-                else:
-                    fn = self.rng.choice(
-                        [self.random_integer, self.random_string]
-                    )
-                parts.append(self.uniquify(fn, length=length))
-            return "_".join(parts)
-        elif self.cfg.function_name == "fixed":
-            # Fixed with the given name, but append _1, _2, etc. if the name is already used.
-            index = 0
-            while True:
-                candidate = (
-                    canonical if index == 0 else canonical + "_" + str(index)
+        return self._name_impl(canonical)
+
+    def _name_random(self, canonical: str) -> str:
+        """Generates a new random function name."""
+        n_parts = self.rng.randint(
+            self.cfg.function_name_min_parts,
+            self.cfg.function_name_max_parts,
+        )
+        parts: list[str] = []
+        length = self.cfg.function_name_part_length
+        for i in range(n_parts):
+            if i == 0:
+                fn = self.random_string
+            elif i == 1:
+                fn = self.random_integer
+            else:
+                fn = self.rng.choice(
+                    [self.random_integer, self.random_string]
                 )
-                if candidate not in self.used_values:
-                    self.used_values.add(candidate)
-                    return candidate
-                index += 1
-        else:
-            raise ValueError("function_name must be 'fixed' or 'random'")
+            parts.append(self.uniquify(fn, length=length))
+        return "_".join(parts)
+
+    def _name_fixed(self, canonical: str) -> str:
+        """Generates a new function name from the canonical name."""
+        # Fixed with the given name, but append _1, _2, etc. if the name is already used.
+        # Indices below the counter are known to be used, so resume from there.
+        index = self._name_counter.get(canonical, 0)
+        while True:
+            candidate = (
+                canonical if index == 0 else canonical + "_" + str(index)
+            )
+            if candidate not in self.used_values:
+                self.used_values.add(candidate)
+                self._name_counter[canonical] = index + 1
+                return candidate
+            index += 1
 
-    def call_graph_comment(self, direction, func_names):
+    def call_graph_comment(self, direction: str, func_names: list[str]) -> str:
         template_variant = self.cfg.call_graph_template_variant
         if template_variant == "calls_called_by":
             if direction == "calls":
@@ -124,7 +159,7 @@ class TaskBuilder:
 
         call_graph_comment_position = self.cfg.call_graph_comment_position
 
-        def add_comment(comment, func_decl):
+        def add_comment(comment: str, func_decl: str) -> str:
             if call_graph_comment_position == "before":
                 return comment + func_decl
             elif call_graph_comment_position == "after":
@@ -167,7 +202,7 @@ class TaskBuilder:
             f" {return_value}",
         )
 
-    def build(self, variant):
+    def build(self, variant: str) -> tuple[list[str], str, str]:
         if variant == "three-step":
             return self.three_step()
         else: